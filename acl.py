@@ -0,0 +1,235 @@
+import sqlite3
+import logging
+import re
+
+
+class acl:
+    """
+    Access control list
+
+    Assigns user levels to hostmasks, such as `*!*@staff.example.net` or `nick!*@*`, either everywhere or in one
+    channel only. If several rules match, the highest level wins; users keep their level from the user table if that
+    is higher.
+
+    Since levels are checked for every message, the rules are compiled into an index: a hash of exact hostnames (for
+    `*!*@host` rules), a trie of hostname suffixes (for `*!*@*.domain` rules) and, for everything else, one regular
+    expression per channel combining all remaining rules. Results are cached per hostmask until the rules change.
+    """
+    CACHE_SIZE = 10000
+
+    def __init__(self, irc):
+        """
+        :param irc:  IRC interface
+        """
+        self.irc = irc
+        self.dbconn = irc.db
+        self.database_setup()
+
+        self.exact = {}
+        self.suffixes = {}
+        self.patterns = {}
+        self.cache = {}
+        self.compile()
+
+    def database_setup(self):
+        """
+        Make sure we have a database connection to work with, and create acl table if it does not exist yet
+        """
+        self.db = self.dbconn.cursor()
+
+        try:
+            self.db.execute("SELECT * FROM acl LIMIT 1")
+        except sqlite3.OperationalError:
+            self.db.execute("CREATE TABLE acl (mask TEXT, channel TEXT, level INT, UNIQUE (mask, channel))")
+            self.dbconn.commit()
+
+    def normalize(self, mask):
+        """
+        Turn a (partial) hostmask into a full, lower case one
+
+        `nick` becomes `nick!*@*`, and `ident@host` becomes `*!ident@host`.
+
+        :param string mask:  Mask
+        :return string:  Full mask
+        """
+        mask = mask.lower()
+        if "@" not in mask:
+            mask = mask + "!*@*" if "!" not in mask else mask + "@*"
+        elif "!" not in mask:
+            mask = "*!" + mask
+
+        return mask
+
+    def is_valid(self, mask):
+        """
+        Check if a mask is a full hostmask, i.e. of the form `nick!ident@host`
+
+        :param string mask:  Mask, as returned by normalize()
+        :return bool:
+        """
+        return re.match(r"[^!@\s]+![^!@\s]+@[^!@\s]+\Z", mask) is not None
+
+    def compile(self):
+        """
+        (Re)build the index from the rules in the database
+
+        Rules with a malformed mask are skipped.
+        """
+        self.exact = {}
+        self.suffixes = {}
+        self.patterns = {}
+        self.cache = {}
+
+        patterns = {}
+        for rule in self.db.execute("SELECT mask, channel, level FROM acl").fetchall():
+            mask, channel, level = rule
+            if not self.is_valid(mask):
+                self.irc.debug("Skipping access rule with invalid mask %s", mask, level=logging.WARNING,
+                               category="acl")
+                continue
+
+            nickname, rest = mask.split("!", 1)
+            ident, host = rest.split("@", 1)
+
+            if nickname != "*" or ident != "*":
+                patterns.setdefault(channel, []).append((level, mask))
+            elif not self.is_wildcard(host):
+                self.add_level(self.exact.setdefault(host, {}), channel, level)
+            elif host.startswith("*.") and not self.is_wildcard(host[2:]):
+                node = self.suffixes
+                for label in reversed(host[2:].split(".")):
+                    node = node.setdefault(label, {})
+                self.add_level(node.setdefault(None, {}), channel, level)
+            else:
+                patterns.setdefault(channel, []).append((level, mask))
+
+        # the first alternative that matches wins, so order the rules by level, highest first
+        for channel, rules in patterns.items():
+            rules = sorted(rules, reverse=True)
+            regex = "|".join("(?P<rule%i>%s)" % (index, self.translate(mask)) for index, (level, mask) in
+                             enumerate(rules))
+            levels = {"rule%i" % index: level for index, (level, mask) in enumerate(rules)}
+            self.patterns[channel] = (re.compile(regex), levels)
+
+    def is_wildcard(self, mask):
+        """
+        Check if a mask contains wildcards
+
+        :param string mask:  Mask
+        :return bool:
+        """
+        return "*" in mask or "?" in mask
+
+    def translate(self, mask):
+        """
+        Turn a mask into a regular expression
+
+        Only `*` (anything) and `?` (any one character) are wildcards; everything else, including the square
+        brackets that may be part of a nickname, is matched literally.
+
+        :param string mask:  Mask
+        :return string:  Regular expression that matches the whole hostmask
+        """
+        return re.escape(mask).replace("\\*", ".*").replace("\\?", ".") + r"\Z"
+
+    def add_level(self, levels, channel, level):
+        """
+        Add a level to a channel -> level mapping, keeping the highest level per channel
+
+        :param dict levels:  Mapping to add to
+        :param string channel:  Channel, or empty for everywhere
+        :param int level:  Level
+        """
+        levels[channel] = max(level, levels.get(channel, level))
+
+    def level(self, hostmask, channel=""):
+        """
+        Get the level the rules assign to a hostmask
+
+        :param string hostmask:  Full hostmask, e.g. `nick!ident@host`
+        :param string channel:  Channel to check channel-specific rules for, if any
+        :return int:  The highest matching level, or `None` if no rule matches
+        """
+        try:
+            return self.cache[(hostmask, channel)]
+        except KeyError:
+            pass
+
+        lower_hostmask = hostmask.lower()
+        host = lower_hostmask[lower_hostmask.find("@") + 1:]
+        channels = ("", channel.lower()) if channel else ("",)
+        candidates = []
+
+        if host in self.exact:
+            candidates.append(self.exact[host])
+
+        node = self.suffixes
+        labels = host.split(".")
+        for index in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[index])
+            if node is None:
+                break
+            if None in node:
+                candidates.append(node[None])
+
+        level = None
+        for levels in candidates:
+            for rule_channel in channels:
+                if rule_channel in levels and (level is None or levels[rule_channel] > level):
+                    level = levels[rule_channel]
+
+        for rule_channel in channels:
+            if rule_channel in self.patterns:
+                regex, levels = self.patterns[rule_channel]
+                match = regex.match(lower_hostmask)
+                if match and (level is None or levels[match.lastgroup] > level):
+                    level = levels[match.lastgroup]
+
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache = {}
+        self.cache[(hostmask, channel)] = level
+
+        return level
+
+    def add(self, mask, level, channel=""):
+        """
+        Add a rule, or change the level of an existing one
+
+        :param string mask:  Hostmask, may contain wildcards
+        :param int level:  User level
+        :param string channel:  Channel the rule applies to; leave empty for everywhere
+        :return bool:  Whether the rule was added; `False` if the mask is not of the form `nick!ident@host`
+        """
+        mask = self.normalize(mask)
+        if not self.is_valid(mask):
+            return False
+
+        self.db.execute("INSERT OR REPLACE INTO acl (mask, channel, level) VALUES (?, ?, ?)",
+                        (mask, channel.lower(), int(level)))
+        self.dbconn.commit()
+        self.compile()
+
+        return True
+
+    def remove(self, mask, channel=""):
+        """
+        Remove a rule
+
+        :param string mask:  Hostmask, as it was added
+        :param string channel:  Channel the rule applies to
+        :return bool:  Whether there was such a rule
+        """
+        self.db.execute("DELETE FROM acl WHERE mask = ? AND channel = ?", (self.normalize(mask), channel.lower()))
+        removed = self.db.rowcount > 0
+        self.dbconn.commit()
+        self.compile()
+
+        return removed
+
+    def rules(self):
+        """
+        Get all rules
+
+        :return list:  Rules, as (mask, channel, level) tuples
+        """
+        return [tuple(rule) for rule in self.db.execute("SELECT mask, channel, level FROM acl ORDER BY channel, mask")]
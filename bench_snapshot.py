@@ -0,0 +1,159 @@
+"""
+Run me to see how much starting from a snapshot speeds up getting back into channels
+
+The bot is started twice against a fake IRC server on localhost: once without a snapshot, and once with the snapshot
+saved by the first run, with a few people having come and gone in between. For both starts, the amount of WHOIS
+lookups the bot sends is counted, along with the time it takes until the bot knows the hostmask of everyone in its
+channels. The database and snapshot files are temporary, so this does not touch anything in `data/`.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from data.config import config
+
+CHANNELS = 10
+MEMBERS = 300  # per channel; half of them are in every channel
+CHURN = 0.05  # share of members replaced between the two runs
+WHOIS_DELAY = 0.002  # seconds the fake server takes to answer a WHOIS, standing in for server-side flood control
+
+
+class fake_server:
+    """
+    Just enough of an IRC server to log on to, join channels on, and look people up on
+    """
+    def __init__(self, members):
+        """
+        :param dict members:  Channel -> list of nicknames in it
+        """
+        self.members = members
+        self.whois = 0
+
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        """
+        Answer the bot, until it disconnects
+        """
+        connection, address = self.socket.accept()
+        for line in connection.makefile("r", encoding="utf-8"):
+            words = line.strip().split(" ")
+            if words[0] == "USER":
+                self.send(connection, ["001 %s :Welcome" % config.nickname, "376 %s :End of MOTD" % config.nickname])
+            elif words[0] == "JOIN":
+                for channel in words[1].split(","):
+                    self.join(connection, channel)
+            elif words[0] == "WHOIS":
+                self.whois += 1
+                time.sleep(WHOIS_DELAY)
+                self.send(connection, ["311 %s %s ident %s.example.net * :%s" % (config.nickname, words[1], words[1],
+                                                                                 words[1])])
+            elif words[0] == "QUIT":
+                break
+
+        connection.close()
+        self.socket.close()
+
+    def join(self, connection, channel):
+        """
+        Let the bot join a channel
+
+        :param connection:  Connection to the bot
+        :param string channel:  Channel
+        """
+        lines = [":%s!ident@bot.example.net JOIN %s" % (config.nickname, channel)]
+        nicknames = self.members.get(channel, [])
+        for index in range(0, len(nicknames), 20):
+            lines.append("353 %s = %s :%s" % (config.nickname, channel, " ".join(nicknames[index:index + 20])))
+        lines.append("366 %s %s :End of NAMES list" % (config.nickname, channel))
+
+        self.send(connection, lines)
+
+    def send(self, connection, lines):
+        """
+        Send lines to the bot, prefixed with the server name if they do not have a prefix of their own
+
+        :param connection:  Connection to the bot
+        :param list lines:  Lines to send
+        """
+        connection.sendall("".join(
+            (line if line.startswith(":") else ":irc.example.net " + line) + "\r\n" for line in lines).encode("utf-8"))
+
+
+def members(run):
+    """
+    Make up who is in which channel
+
+    :param int run:  Which run this is for; with every run, some people are replaced by others
+    :return dict:  Channel -> list of nicknames
+    """
+    replaced = int(MEMBERS * CHURN) * run
+    channels = {}
+    for channel in range(CHANNELS):
+        nicknames = ["regular%i" % index for index in range(MEMBERS // 2)]
+        nicknames += ["visitor%i_%i" % (channel, index) for index in range(replaced, replaced + MEMBERS // 2)]
+        channels["#bench%i" % channel] = nicknames
+
+    return channels
+
+
+def start(run):
+    """
+    Start the bot, and wait until it knows everyone in its channels
+
+    :param int run:  Which run this is
+    :return tuple:  Amount of WHOIS lookups sent, and the time it took, in seconds
+    """
+    from snekbot import snekbot
+
+    class bench_bot(snekbot):
+        def tick(self):
+            super().tick()
+
+            tracker = self.channel_tracker
+            joined = all(channel in tracker.members and channel not in tracker.stale for channel in channels)
+            if joined and all(nickname.lower() in tracker.hostmasks for channel in channels for nickname in
+                              channels[channel]):
+                self.usable_at = time.perf_counter()
+                self.alive = False
+
+    channels = members(run)
+    server = fake_server(channels)
+    config.port = server.port
+
+    started = time.perf_counter()
+    bot = bench_bot()
+    bot.listen()
+    taken = bot.usable_at - started
+
+    bot.die()
+    return server.whois, taken
+
+
+with tempfile.TemporaryDirectory() as folder:
+    config.host = "127.0.0.1"
+    config.preferredchannels = ["#bench%i" % channel for channel in range(CHANNELS)]
+    config.dbfile = os.path.join(folder, "snekbot.db")
+    config.snapshot_file = os.path.join(folder, "snapshot.json.gz")
+    config.debug_logfile = ""
+    config.debug_level = "WARNING"
+    config.tick_interval = 0.01
+    config.lag_interval = 3600
+
+    cold_whois, cold_time = start(0)
+    warm_whois, warm_time = start(1)
+
+print("%i channels of %i members, %i%% of them new after restarting, %.1f ms per WHOIS" % (
+    CHANNELS, MEMBERS, CHURN * 100, WHOIS_DELAY * 1000))
+print("without snapshot:  %5i WHOIS lookups, usable after %6.3f s" % (cold_whois, cold_time))
+print("with snapshot:     %5i WHOIS lookups, usable after %6.3f s" % (warm_whois, warm_time))
+print("speedup:           %8.1fx" % (cold_time / warm_time))
@@ -0,0 +1,83 @@
+"""
+Run me to see how the plugin key-value store compares to writing every change to the database right away
+
+Both sides do the same work: a number of increments spread over a set of counters, as a plugin counting e.g. messages
+per user would. The database files are temporary, so this does not touch `data/snekbot.db`.
+"""
+
+import os
+import sqlite3
+import tempfile
+import time
+
+from store import key_value_store
+
+OPERATIONS = 20000
+KEYS = 200
+
+
+class bench_irc:
+    """
+    Just enough of an IRC interface for the store to work with
+    """
+    def __init__(self, db):
+        """
+        :param db:  Database connection
+        """
+        self.db = db
+
+    def debug(self, msg, *args, **kwargs):
+        print(msg % args)
+
+
+def bench_store(path):
+    """
+    Increment counters through the key-value store
+
+    :param string path:  Database file
+    :return float:  Seconds taken, including the final flush
+    """
+    db = sqlite3.connect(path)
+    store = key_value_store(bench_irc(db))
+
+    start = time.perf_counter()
+    for operation in range(OPERATIONS):
+        store.increment("bench", "counter-%i" % (operation % KEYS))
+    store.flush()
+    taken = time.perf_counter() - start
+
+    db.close()
+    return taken
+
+
+def bench_commit_per_write(path):
+    """
+    Increment counters by reading and writing the database directly, committing every change
+
+    :param string path:  Database file
+    :return float:  Seconds taken
+    """
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE counters (key TEXT PRIMARY KEY, value INT)")
+    db.commit()
+
+    start = time.perf_counter()
+    for operation in range(OPERATIONS):
+        key = "counter-%i" % (operation % KEYS)
+        row = db.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        db.execute("INSERT OR REPLACE INTO counters (key, value) VALUES (?, ?)", (key, (row[0] if row else 0) + 1))
+        db.commit()
+    taken = time.perf_counter() - start
+
+    db.close()
+    return taken
+
+
+with tempfile.TemporaryDirectory() as folder:
+    store_time = bench_store(os.path.join(folder, "store.db"))
+    commit_time = bench_commit_per_write(os.path.join(folder, "commit.db"))
+
+print("%i increments over %i keys" % (OPERATIONS, KEYS))
+print("key-value store:   %8.3f s (%8.1f us per operation)" % (store_time, store_time / OPERATIONS * 1000000))
+print("commit per write:  %8.3f s (%8.1f us per operation)" % (commit_time, commit_time / OPERATIONS * 1000000))
+print("speedup:           %8.1fx" % (commit_time / store_time))
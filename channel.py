@@ -0,0 +1,293 @@
+class channel_tracker:
+    """
+    Channel tracker
+
+    Keeps track of who is in the channels the bot is in, their channel modes (op, voice, ...), the modes of the
+    channels themselves, and the hostmasks of everyone we share a channel with.
+
+    Channel names and nicknames are stored in lower case, since IRC treats them case-insensitively.
+
+    After a reconnect, or when restored from a snapshot, the tracked channels are stale: they are kept, so the
+    hostmasks of their members need not be looked up again, but are ignored until the server has sent a fresh member
+    list for them.
+    """
+    def __init__(self, irc):
+        """
+        :param irc_client irc:  IRC interface
+        """
+        self.irc = irc
+
+        self.members = {}
+        self.modes = {}
+        self.hostmasks = {}
+        self.pending_names = {}
+        self.stale = set()
+        self.looking_up = set()
+
+    def prefixes(self):
+        """
+        Get the nickname prefixes the server uses for user channel modes
+
+        :return dict:  Prefix symbol -> mode, e.g. `{"@": "o", "+": "v"}`
+        """
+        prefix = self.irc.isupport.get("PREFIX", "(ov)@+")
+        if not prefix.startswith("(") or ")" not in prefix:
+            return {}
+
+        modes, symbols = prefix[1:].split(")", 1)
+        return dict(zip(symbols, modes))
+
+    def join(self, channel, nickname, hostmask):
+        """
+        Register someone joining a channel
+
+        :param channel:  Channel
+        :param nickname:  Who joined
+        :param hostmask:  Full hostmask of who joined
+        """
+        self.members.setdefault(channel.lower(), {})[nickname.lower()] = ""
+        self.hostmasks[nickname.lower()] = hostmask
+
+    def part(self, channel, nickname):
+        """
+        Register someone leaving a channel, by parting or being kicked
+
+        If that someone is us, we forget about the channel altogether.
+
+        :param channel:  Channel
+        :param nickname:  Who left
+        """
+        channel = channel.lower()
+        if nickname.lower() == self.irc.nickname.lower():
+            self.forget(channel)
+            return
+        elif channel in self.members:
+            self.members[channel].pop(nickname.lower(), None)
+
+        if not self.is_known(nickname):
+            self.hostmasks.pop(nickname.lower(), None)
+
+    def forget(self, channel):
+        """
+        Forget about a channel, e.g. because we left it or could not rejoin it
+
+        Hostmasks of people that are not in any other channel we track are forgotten as well.
+
+        :param channel:  Channel
+        """
+        channel = channel.lower()
+        former_members = self.members.pop(channel, {})
+        self.modes.pop(channel, None)
+        self.pending_names.pop(channel, None)
+        self.stale.discard(channel)
+
+        for nickname in former_members:
+            if not any(nickname in members for members in self.members.values()):
+                self.hostmasks.pop(nickname, None)
+
+    def mark_stale(self):
+        """
+        Mark all tracked channels as stale
+
+        To be called when the connection is lost: the channels will need to be rejoined, and we cannot know who is
+        in them until we have.
+        """
+        self.stale = set(self.members)
+        self.pending_names = {}
+        self.looking_up = set()
+
+    def quit(self, nickname):
+        """
+        Register someone quitting IRC
+
+        :param nickname:  Who quit
+        :return list:  Channels they were in
+        """
+        nickname = nickname.lower()
+        channels = [channel for channel, members in self.members.items() if nickname in members]
+        for channel in channels:
+            del self.members[channel][nickname]
+
+        self.hostmasks.pop(nickname, None)
+        return channels
+
+    def rename(self, nickname, new_nickname):
+        """
+        Register a nickname change
+
+        :param nickname:  Old nickname
+        :param new_nickname:  New nickname
+        :return list:  Channels they are in
+        """
+        nickname = nickname.lower()
+
+        channels = []
+        for channel, members in self.members.items():
+            if nickname in members:
+                members[new_nickname.lower()] = members.pop(nickname)
+                channels.append(channel)
+
+        if nickname in self.hostmasks:
+            hostmask = self.hostmasks.pop(nickname)
+            self.hostmasks[new_nickname.lower()] = new_nickname + hostmask[hostmask.find("!"):]
+
+        return channels
+
+    def seen(self, nickname, hostmask):
+        """
+        Register the hostmask of someone who sent us something, if we share a channel with them
+
+        :param nickname:  Nickname
+        :param hostmask:  Full hostmask
+        """
+        if self.hostmasks.get(nickname.lower()) != hostmask and self.is_known(nickname):
+            self.hostmasks[nickname.lower()] = hostmask
+
+    def whois(self, nickname, hostmask):
+        """
+        Register a hostmask learned from a WHOIS reply
+
+        :param nickname:  Nickname
+        :param hostmask:  Full hostmask
+        """
+        self.hostmasks[nickname.lower()] = hostmask
+        self.looking_up.discard(nickname.lower())
+
+    def whois_end(self, nickname):
+        """
+        Wrap up a WHOIS reply, whether or not the server knew who we asked about
+
+        :param nickname:  Nickname
+        """
+        self.looking_up.discard(nickname.lower())
+
+    def mode(self, channel, modes, params):
+        """
+        Apply a mode change to a channel
+
+        Modes that take a parameter are recognized through the server's PREFIX and CHANMODES features. List modes
+        (e.g. bans) are not tracked.
+
+        :param channel:  Channel
+        :param modes:  Mode string, e.g. `+o-v`
+        :param list params:  Mode parameters
+        """
+        channel = channel.lower()
+        if channel not in self.members:
+            return
+
+        prefixes = self.prefixes()
+        prefix_modes = "".join(prefixes.values())
+        chanmodes = self.irc.isupport.get("CHANMODES", "beI,k,l,imnpst").split(",") + ["", "", "", ""]
+        list_modes, param_modes, set_param_modes = chanmodes[0:3]
+
+        params = list(params)
+        adding = True
+        for mode in modes:
+            if mode in "+-":
+                adding = (mode == "+")
+                continue
+
+            param = None
+            takes_param = mode in prefix_modes + list_modes + param_modes or (adding and mode in set_param_modes)
+            if takes_param and params:
+                param = params.pop(0)
+
+            if mode in prefix_modes:
+                if param and param.lower() in self.members[channel]:
+                    current = self.members[channel][param.lower()].replace(mode, "")
+                    self.members[channel][param.lower()] = current + mode if adding else current
+            elif mode in list_modes:
+                continue
+            elif adding:
+                self.modes.setdefault(channel, {})[mode] = param
+            else:
+                self.modes.setdefault(channel, {}).pop(mode, None)
+
+    def channel_modes(self, channel, modes, params):
+        """
+        Register the full set of modes of a channel, as given in a RPL_CHANNELMODEIS reply
+
+        :param channel:  Channel
+        :param modes:  Mode string
+        :param list params:  Mode parameters
+        """
+        self.modes[channel.lower()] = {}
+        self.mode(channel, modes, params)
+
+    def names(self, channel, nicknames):
+        """
+        Register (part of) a NAMES reply
+
+        Replies may be spread over several messages; the channel's member list is only replaced once the list is
+        complete (see names_end()).
+
+        :param channel:  Channel
+        :param list nicknames:  Nicknames, prefixed with their channel mode symbols
+        """
+        prefixes = self.prefixes()
+        members = self.pending_names.setdefault(channel.lower(), {})
+
+        for nickname in nicknames:
+            modes = ""
+            while nickname and nickname[0] in prefixes:
+                modes += prefixes[nickname[0]]
+                nickname = nickname[1:]
+
+            if nickname:
+                members[nickname.lower()] = modes
+
+    def names_end(self, channel):
+        """
+        Wrap up a NAMES reply
+
+        :param channel:  Channel
+        :return list:  Members of the channel whose hostmask we do not know, and are not looking up already
+        """
+        members = self.pending_names.pop(channel.lower(), {})
+        self.members[channel.lower()] = members
+        self.stale.discard(channel.lower())
+
+        unknown = [nickname for nickname in members if nickname not in self.hostmasks and
+                   nickname not in self.looking_up]
+        self.looking_up.update(unknown)
+
+        return unknown
+
+    def is_known(self, nickname):
+        """
+        Check if we share a channel with someone
+
+        Stale channels (see mark_stale()) do not count.
+
+        :param nickname:  Nickname
+        :return bool:
+        """
+        nickname = nickname.lower()
+        return any(nickname in members for channel, members in self.members.items() if channel not in self.stale)
+
+    def get_state(self):
+        """
+        Get tracked state, for snapshotting
+
+        Stale channels, and hostmasks of people we no longer share a channel with, are left out.
+
+        :return dict:
+        """
+        members = {channel: members for channel, members in self.members.items() if channel not in self.stale}
+        modes = {channel: modes for channel, modes in self.modes.items() if channel not in self.stale}
+        hostmasks = {nickname: hostmask for nickname, hostmask in self.hostmasks.items() if self.is_known(nickname)}
+        return {"members": members, "modes": modes, "hostmasks": hostmasks}
+
+    def set_state(self, state):
+        """
+        Restore tracked state from a snapshot
+
+        The restored channels are stale until we have rejoined them.
+
+        :param dict state:  State, as returned by get_state()
+        """
+        self.members = state.get("members", {})
+        self.modes = state.get("modes", {})
+        self.hostmasks = state.get("hostmasks", {})
+        self.mark_stale()
@@ -3,8 +3,11 @@ import inspect
 import glob
 import sys
 import gc
+import json
+import logging
 
 import os.path as path
+from store import key_value_store
 from data.config import config
 
 
@@ -16,6 +19,10 @@ class command_module:
     """
     commands = []
     plugins = {}
+    listeners = {}
+    subscriptions = {}
+
+    EVENTS = ["PRIVMSG", "NOTICE", "JOIN", "PART", "KICK", "QUIT", "NICK", "TOPIC", "MODE"]
 
     def __init__(self, irc):
         """
@@ -33,10 +40,11 @@ class command_module:
         """
         Set up database connection
 
-        We have no table to set up here, so not much to do
+        We have no table to set up here, so not much to do, apart from setting up the key-value store plugins can use
         """
         self.dbconn = self.irc.db
         self.db = self.dbconn.cursor()
+        self.store = key_value_store(self.irc)
 
     def load_plugins(self):
         """
@@ -49,9 +57,18 @@ class command_module:
         For example, if there's a plugin.py which contains a class named "hello" that has a `command` method, that
         class will be instantiated, with a database cursor as the first constructor argument, and its `command()` method
         called with `message`, `channel` and `user` as arguments when someone says "!hello".
+
+        Classes may also (or instead) implement event methods, e.g. `on_join`, to be called for IRC events other than
+        commands; see `dispatch_event()`.
+
+        State of plugins that were already loaded (see `base_plugin.get_state()`) is passed on to their reloaded
+        versions.
         """
-        if self.plugins != {}:
+        states = self.get_plugin_states()
+
+        if self.plugins != {} or self.listeners != {}:
             self.plugins = {}
+            self.listeners = {}
             gc.collect()
 
         # get all python files in the plugin folder
@@ -74,12 +91,118 @@ class command_module:
 
             plugin_classes = inspect.getmembers(module, inspect.isclass)
             for plugin_class in plugin_classes:
-                # check if class has a "command" method
+                # check if class has a "command" method, or any event methods
                 plugin_caller = getattr(plugin_class[1], "command", None)
+                events = [event for event in self.EVENTS
+                          if callable(getattr(plugin_class[1], "on_" + event.lower(), None))]
+
+                if inspect.isabstract(plugin_class[1]):
+                    continue
 
                 # add that class as a hook that can be called!
-                if not inspect.isabstract(plugin_class[1]) and callable(plugin_caller):
+                if callable(plugin_caller):
                     self.plugins[plugin_class[0]] = plugin_class[1](self)
+                elif events:
+                    self.listeners[plugin_class[0]] = plugin_class[1](self)
+
+        self.index_subscriptions()
+        self.set_plugin_states(states)
+
+    def index_subscriptions(self):
+        """
+        Index which plugins are interested in which events
+
+        The index maps event types to channels to the methods to call, so dispatching an event only involves the
+        plugins that subscribed to it. Plugins that do not limit themselves to specific channels (through their
+        `channels` attribute) are indexed under channel `None`.
+        """
+        self.subscriptions = {}
+
+        for plugin in list(self.plugins.values()) + list(self.listeners.values()):
+            channels = getattr(plugin, "channels", None)
+            channels = [None] if not channels else [channel.lower() for channel in channels]
+
+            for event in self.EVENTS:
+                method = getattr(plugin, "on_" + event.lower(), None)
+                if not callable(method):
+                    continue
+
+                for channel in channels:
+                    self.subscriptions.setdefault(event, {}).setdefault(channel, []).append(method)
+
+    def dispatch_event(self, event, message, channel, user, channels=None):
+        """
+        Pass an IRC event on to the plugins that subscribed to it
+
+        Subscribed plugins have their `on_<event>` method called, e.g. `on_join(message, channel, user)`.
+
+        QUIT and NICK events are not tied to a channel; they are passed to plugins that subscribed to any of the
+        channels the user was in, with an empty `channel`.
+
+        :param string event:  Event type, one of `EVENTS`
+        :param string message:  Message, e.g. part message or new nickname
+        :param string channel:  Channel the event happened in
+        :param user.user user:  User that caused the event
+        :param list channels:  Channels the event applies to, if it has no channel of its own
+        """
+        index = self.subscriptions.get(event)
+        if not index:
+            return
+
+        subscribers = index.get(None, [])
+        for event_channel in ([channel] if channel else channels or []):
+            if event_channel.lower() in index:
+                subscribers = subscribers + index[event_channel.lower()]
+
+        for method in dict.fromkeys(subscribers):
+            try:
+                method(message, channel, user)
+            except Exception as error_message:
+                # a broken plugin should not take the rest of the bot down with it
+                self.irc.debug("Error in %s handler: %s", event, error_message, level=logging.ERROR, category="plugin")
+
+    def get_plugin_states(self):
+        """
+        Get the state plugins want to keep
+
+        Plugins whose state cannot be retrieved, or cannot be stored as JSON, are left out.
+
+        :return dict:  Plugin name -> state, for plugins that have any
+        """
+        states = {}
+        for name, plugin in list(self.plugins.items()) + list(self.listeners.items()):
+            get_state = getattr(plugin, "get_state", None)
+            if not callable(get_state):
+                continue
+
+            try:
+                state = get_state()
+                json.dumps(state)
+            except Exception as error_message:
+                # a broken plugin should not keep the rest of the bot from saving its state
+                self.irc.debug("Could not get state of plugin %s: %s", name, error_message, level=logging.ERROR,
+                               category="plugin")
+                continue
+
+            if state is not None:
+                states[name] = state
+
+        return states
+
+    def set_plugin_states(self, states):
+        """
+        Pass saved state on to plugins
+
+        :param dict states:  Plugin name -> state, as returned by `get_plugin_states()`
+        """
+        plugins = {**self.plugins, **self.listeners}
+        for name, state in states.items():
+            if name in plugins and callable(getattr(plugins[name], "set_state", None)):
+                try:
+                    plugins[name].set_state(state)
+                except Exception as error_message:
+                    self.irc.debug("Could not restore state of plugin %s: %s", name, error_message,
+                                   level=logging.ERROR, category="plugin")
 
     def process(self, message, channel, user):
         """
@@ -87,6 +210,7 @@ class command_module:
 
         Pretty much the most important method! If the method called for the command returns `True`, the
         command will be saved as the last succesful command, and may be called again easily via `!2`.
+        `!more` sends the next page of the user's last paged reply, to wherever that reply was sent.
 
         :param string message:  The message to process
         :param string channel:  The channel the message was said on
@@ -98,6 +222,8 @@ class command_module:
 
             if command == "2" and self.lastcommand != "":
                 self.process(self.lastcommand, channel, user)
+            elif command == "more":
+                done = self.irc.more(user.hostname)
             elif command in self.plugins:
                 # plugin commands (could be anything!)
                 done = self.plugins[command].command(message, channel, user)
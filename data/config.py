@@ -13,5 +13,38 @@ class config:
     nickserv_curse = "This nickname is registered"
 
     command_prefix = "."
+    reply_max_lines = 4  # longer replies are paged, use the "more" command to see the rest
+    reply_max_pages = 100  # how many users' paged replies to keep
     preferredchannels = ["##snekbot"]
+
+    connect_timeout = 15
+    reconnect_backoff_base = 1  # seconds; doubled with every failed attempt...
+    reconnect_backoff_max = 300  # ...up to this
+    tick_interval = 1  # how often to run periodic tasks, in seconds
+    lag_interval = 60  # how often to measure lag, in seconds
+    stall_timeout = 180  # reconnect if nothing was received, or lag check answered, for this long, in seconds
     dbfile = "data/snekbot.db"
+
+    snapshot_file = "data/snapshot.json.gz"
+    snapshot_interval = 300  # seconds between periodic state snapshots
+    snapshot_max_age = 86400  # older snapshots are ignored on startup, in seconds
+
+    store_cache_size = 1000  # plugin key-value store values kept in memory, at most
+    store_flush_size = 100  # write changes to the store to the database once this many are pending...
+    store_flush_interval = 10  # ...or after this many seconds
+
+    backlog_size = 1000  # incoming events waiting to be processed, at most
+    # if the backlog is full, events are pushed out in this order (see irc_client.enqueue()):
+    # dropped first: chatter (PRIVMSGs that are not commands), MOTD and server statistics
+    backlog_low_priority = ["PRIVMSG", "250", "251", "252", "253", "254", "255", "265", "266", "372", "375"]
+    # then: applied to the channel tracker right away, but not logged or passed to plugins
+    backlog_coalesce = ["JOIN", "PART", "KICK", "QUIT", "NICK", "MODE", "311", "318", "324", "353", "366"]
+    # then: everything else, commands included, is dropped; except these, which are never dropped
+    backlog_keep = ["ERROR", "001", "005", "376", "396", "403", "405", "422", "433", "471", "473", "474", "475"]
+
+    debug_level = "DEBUG"  # DEBUG, INFO, WARNING or ERROR
+    debug_logfile = "data/snekbot.log"  # leave empty to only log to the console
+    debug_logfile_size = 1024 * 1024
+    debug_logfile_backups = 3
+    debug_ringbuffer_size = 500
+    debug_sampling = {}  # category: n, to only log one in every n events of that category, e.g. {"privmsg": 10}
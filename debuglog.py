@@ -0,0 +1,144 @@
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+
+from data.config import config
+
+
+class ring_buffer_handler(logging.Handler):
+    """
+    Log handler that keeps the most recent records in memory
+
+    This allows admins to see what the bot has been up to without needing access to the console or log file.
+    """
+    def __init__(self, size):
+        """
+        :param int size:  Amount of records to keep
+        """
+        super().__init__()
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        """
+        Store record
+
+        :param logging.LogRecord record:  Record to store
+        """
+        self.records.append(record)
+
+
+class structured_formatter(logging.Formatter):
+    """
+    Formatter that appends the structured fields of a record as key=value pairs
+    """
+    def format(self, record):
+        """
+        Format record
+
+        :param logging.LogRecord record:  Record to format
+        :return string:  Formatted record
+        """
+        formatted = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            formatted += " " + " ".join("%s=%r" % (key, value) for key, value in fields.items())
+
+        return formatted
+
+
+class debug_logger:
+    """
+    Debug logger
+
+    Leveled, structured debug logging. Records are only formatted if their level is enabled, and are then handed to a
+    background thread that writes them to the console and a rotating log file, so a slow terminal or pipe does not
+    hold up the bot. The most recent records are also kept in memory, and high-volume categories of events may be
+    sampled (see `config.debug_sampling`).
+    """
+    def __init__(self, name="snekbot"):
+        """
+        Set up logger and start the background thread
+
+        :param string name:  Name of the logger
+        """
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(getattr(logging, config.debug_level.upper(), logging.DEBUG))
+        self.logger.propagate = False
+
+        self.sample_counters = collections.Counter()
+        self.sampled_out = collections.Counter()
+
+        self.ring_buffer = ring_buffer_handler(config.debug_ringbuffer_size)
+
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter("%(message)s"))
+        handlers = [console, self.ring_buffer]
+
+        if config.debug_logfile:
+            logfile = logging.handlers.RotatingFileHandler(config.debug_logfile, maxBytes=config.debug_logfile_size,
+                                                           backupCount=config.debug_logfile_backups, encoding="utf-8")
+            logfile.setFormatter(
+                structured_formatter("%(asctime)s %(levelname)-8s %(category)-10s %(message)s"))
+            handlers.append(logfile)
+
+        self.queue = queue.Queue(-1)
+        self.logger.handlers = [logging.handlers.QueueHandler(self.queue)]
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+
+    def log(self, level, msg, *args, category="general", **fields):
+        """
+        Log a message
+
+        The message is only formatted (with `args`, %-style) if the level is enabled and the event was not sampled
+        out. Warnings and errors are never sampled.
+
+        :param int level:  Log level, e.g. `logging.DEBUG`
+        :param string msg:  Message, optionally with %-style placeholders
+        :param args:  Values for placeholders
+        :param string category:  Category of event, used for sampling and filtering
+        :param fields:  Any structured data to store with the record
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+
+        rate = config.debug_sampling.get(category, 1) if level < logging.WARNING else 1
+        if rate > 1:
+            self.sample_counters[category] += 1
+            if self.sample_counters[category] % rate != 1:
+                self.sampled_out[category] += 1
+                return
+
+        self.logger.log(level, msg, *args, extra={"category": category, "fields": fields})
+
+    def is_enabled(self, level):
+        """
+        Check if messages of a given level would be logged
+
+        Useful if preparing the arguments for a log message is expensive in itself.
+
+        :param int level:  Log level
+        :return bool:
+        """
+        return self.logger.isEnabledFor(level)
+
+    def recent(self, amount=10):
+        """
+        Get recent log records
+
+        :param int amount:  Amount of records to get, at most
+        :return list:  Most recent records, oldest first
+        """
+        records = list(self.ring_buffer.records)
+        return records[-amount:] if amount > 0 else []
+
+    def stop(self):
+        """
+        Stop the background thread, after writing any records that are still queued
+        """
+        if self.running:
+            self.listener.stop()
+            self.running = False
@@ -1,23 +1,167 @@
 import time
 import socket
+import logging
+import select
+import random
+import collections
 
+from debuglog import debug_logger
 from data.config import config
 
 
 class irc_client:
-    ircbuffer = ""
+    ircbuffer = b""
     ircsocket = ""
     alive = False
     channels = []
-    debugmode = "verbose"
+    debuglog = None
+    hostmask = ""
+    isupport = {}
+    pages = {}
+
+    # backlog tiers, from the first to be dropped when the backlog is full to the last (see enqueue())
+    BACKLOG_TIERS = ("low", "coalesce", "normal", "keep")
 
     def __init__(self):
-        self.ircsocket = socket.socket()
-        self.ircsocket.connect((config.host, config.port))
+        if not self.debuglog:
+            self.debuglog = debug_logger()
+
+        self.hostmask = ""
+        self.isupport = {}
+        self.pages = {}
+
+        self.backlog = {tier: collections.deque() for tier in self.BACKLOG_TIERS}
+        self.backlog_length = 0
+        self.backlog_sequence = 0
+        self.backlog_peak = 0
+        self.backlog_full = False
+        self.backlog_dropped = collections.Counter()
+        self.backlog_coalesced = collections.Counter()
+
+        self.channels = []
+        self.rejoin_channels = []
+        self.disconnected_at = None
+        self.reconnect_attempts = 0
+
+        self.is_registered = False
+        self.lag = None
+        self.lag_sent = 0
+        self.lag_checked = 0
+        self.next_tick = 0
+
+        self.connect()
+
+    def connect(self):
+        """
+        Connect to the IRC server and identify ourselves
+        """
+        self.ircbuffer = b""
+        self.ircsocket = socket.create_connection((config.host, config.port), config.connect_timeout)
+        self.ircsocket.settimeout(None)
         self.alive = True
-        time.sleep(2)
+        self.last_received = time.time()
+        self.is_registered = False
+        self.lag_sent = 0
         self.ident()
 
+    def reconnect(self):
+        """
+        Drop the current connection and set up a new one
+
+        Connecting is retried with exponential backoff until it succeeds; the backoff only resets once the server
+        has accepted our registration, so a server that keeps closing the connection right away is not hammered
+        either. Channels we were in are rejoined once we are registered again (see registered()).
+
+        Any events still in the backlog are discarded, since they refer to the old connection.
+        """
+        if not self.disconnected_at:
+            self.disconnected_at = time.time()
+
+        try:
+            self.ircsocket.close()
+        except socket.error:
+            pass
+
+        for events in self.backlog.values():
+            events.clear()
+        self.backlog_length = 0
+        self.rejoin_channels += [channel for channel in self.channels if channel not in self.rejoin_channels]
+        self.channels = []
+        self.hostmask = ""
+        self.isupport = {}
+
+        while self.alive:
+            if self.reconnect_attempts > 0:
+                delay = min(config.reconnect_backoff_max, config.reconnect_backoff_base * 2 ** self.reconnect_attempts)
+                delay = random.uniform(delay / 2, delay)
+                self.debug("Reconnecting in %.1f seconds (attempt %i)", delay, self.reconnect_attempts + 1,
+                           level=logging.WARNING, category="server")
+                time.sleep(delay)
+
+            self.reconnect_attempts += 1
+            try:
+                self.connect()
+                return
+            except socket.error as message:
+                self.debug("Could not connect to server: %s", message, level=logging.ERROR, category="server")
+
+    def registered(self):
+        """
+        Wrap up logging on to the server
+
+        To be called once the server has accepted our registration. (Re)joins our channels.
+        """
+        self.reconnect_attempts = 0
+        self.is_registered = True
+
+        self.join(config.preferredchannels + self.rejoin_channels)
+        self.rejoin_channels = []
+
+        if self.disconnected_at:
+            self.debug("Rejoining %i channels, %.1f seconds after losing the connection", len(self.channels),
+                       time.time() - self.disconnected_at, level=logging.INFO, category="server")
+            self.disconnected_at = None
+
+    def tick(self):
+        """
+        Periodic tasks
+
+        Called from the main loop about every `config.tick_interval` seconds. Measures lag, by sending a PING of our
+        own every `config.lag_interval` seconds once we are registered, and reconnects if nothing has been received
+        from the server, or our PING has not been answered, for `config.stall_timeout` seconds.
+        """
+        now = time.time()
+
+        if now - self.last_received > config.stall_timeout:
+            self.debug("Nothing received from server for %i seconds, reconnecting", now - self.last_received,
+                       level=logging.WARNING, category="server")
+            self.reconnect()
+            return
+
+        if self.lag_sent and now - self.lag_sent > config.stall_timeout:
+            self.debug("Lag check unanswered for %i seconds, reconnecting", now - self.lag_sent,
+                       level=logging.WARNING, category="server")
+            self.reconnect()
+            return
+
+        if self.is_registered and not self.lag_sent and now - self.lag_checked >= config.lag_interval:
+            self.lag_sent = now
+            self.sendCmd("PING :snekbot-lag")
+
+    def current_lag(self):
+        """
+        Get the current lag to the server
+
+        If a lag check is still awaiting its reply, and has been for longer than the last measured lag, the time
+        since it was sent is returned instead.
+
+        :return float:  Lag in seconds, or `None` if it has not been measured yet
+        """
+        if self.lag_sent and (self.lag is None or time.time() - self.lag_sent > self.lag):
+            return time.time() - self.lag_sent
+
+        return self.lag
+
     def nick(self, nickname=False):
         """
         Set our nickname
@@ -34,6 +178,9 @@ class irc_client:
         """
         Identify ourselves to the IRC server
 
+        Everything is sent in one go without waiting for replies in between. We do not need any capabilities, so
+        capability negotiation is ended right after it starts.
+
         :param identid:  Identity
         :param realname:  Real name to send
         """
@@ -42,19 +189,32 @@ class irc_client:
         if not realname:
             realname = config.realname
 
-        self.nick()
-        self.sendCmd("USER %s %s snekbot :%s\r\n" % (identid, config.host, realname))
+        self.sendCmds([
+            "CAP LS 302",
+            "NICK %s" % config.nickname,
+            "USER %s %s snekbot :%s" % (identid, config.host, realname),
+            "CAP END"
+        ])
         self.nickname = config.nickname
 
     def join(self, channel):
         """
         Join a channel, but only if we're not in it already
 
-        :param channel:  Channel to join
+        :param channel:  Channel to join, or a list of channels to join at once
         """
-        if channel not in self.channels:
-            self.sendCmd("JOIN %s\r\n" % channel)
-            self.channels += [channel]
+        channels = [channel] if isinstance(channel, str) else channel
+        channels = [channel for channel in dict.fromkeys(channels) if channel not in self.channels]
+
+        batches = []
+        for channel in channels:
+            if batches and len(batches[-1]) + len(channel) < 400:
+                batches[-1] += "," + channel
+            else:
+                batches.append(channel)
+
+        self.sendCmds(["JOIN %s" % batch for batch in batches])
+        self.channels += channels
 
     def part(self, channel=False):
         """
@@ -63,10 +223,10 @@ class irc_client:
         :param channel:  Channel to depart - if left empty, depart all channels
         """
         if not channel:
-            for channel in self.channels:
-                self.ircsocket.send("PART %s\r\n" % channel)
+            self.sendCmds(["PART %s" % channel for channel in self.channels])
+            self.channels = []
         else:
-            self.ircsocket.send("PART %s\r\n" % channel)
+            self.sendCmd("PART %s" % channel)
             try:
                 self.channels.remove(channel)
             except ValueError:
@@ -75,53 +235,232 @@ class irc_client:
     def listen(self):
         """
         Main loop
+
+        Incoming lines are read as soon as they arrive, and PINGs among them are answered right away. All other
+        events go into the backlog, which is worked through one event at a time in between reading from the socket,
+        so a burst of activity cannot hold up our PONGs.
         """
         while self.alive:
             try:
-                self.ircbuffer = self.ircbuffer + self.ircsocket.recv(1024).decode("ascii")
+                if time.time() >= self.next_tick:
+                    self.next_tick = time.time() + config.tick_interval
+                    self.tick()
+
+                # only block while waiting for data if there is nothing else to do
+                timeout = 0 if self.backlog_length else max(0, self.next_tick - time.time())
+
+                readable, writable, failed = select.select([self.ircsocket], [], [], timeout)
+                if readable:
+                    data = self.ircsocket.recv(4096)
+                    if not data:
+                        raise socket.error("Connection closed by server")
+                    self.ingest(data)
             except socket.error as message:
-                self.debug("/!\ Socket error '%s', halting script" % message)
-                self.die()
+                self.debug("/!\\ Socket error '%s', reconnecting", message, level=logging.ERROR, category="server")
+                self.reconnect()
+                continue
 
-            lines = self.ircbuffer.split("\n")
-            self.ircbuffer = lines.pop()
-
-            for line in lines:
-                line = line.strip().split(" ")
-
-                if line[0][0] == ":":
-                    sender = line[0][1:]
-                    try:
-                        self.process(line, sender)
-                    except Exception as error_message:
-                        # keep the bot running at all costs!!
-                        self.debug("Error during processing: %s" % error_message)
-                elif line[0] == "PING":
-                    line[1] = line[1][1:]
-                    self.sendCmd("PONG %s\r\n" % line[1])
-                elif line[0] == "ERROR":
-                    msg = " ".join(line[1:])[1:]
-                    self.debug("/!\ Server returned error message '%s', halting script" % msg)
-                    if "Ping timeout" in msg or "Ping Timeout" in msg:
-                        time.sleep(5)
-                        self.__init__()
-                    elif "Closing link" in msg:
-                        time.sleep(5)
-                        self.__init__()
-                    else:
-                        self.die()
+            if self.backlog_length:
+                self.dispatch(self.next_event())
 
         # hopefully we never get out of the above while loop - if we do, it's over
-        self.debug("Disconnected from server. Bye!")
+        self.debug("Disconnected from server. Bye!", level=logging.INFO, category="server")
+        self.debuglog.stop()
 
-    def debug(self, msg):
+    def ingest(self, data):
         """
-        Print debug message in console
+        Split received data into lines, answer PINGs and queue everything else
 
-        :param msg:  Debug message
-        :return:
+        :param bytes data:  Data received from the server
+        """
+        self.last_received = time.time()
+
+        lines = (self.ircbuffer + data).split(b"\n")
+        self.ircbuffer = lines.pop()
+
+        for line in lines:
+            line = line.decode("utf-8", errors="replace").strip().split(" ")
+
+            if not line[0]:
+                continue
+            elif line[0] == "PING":
+                token = " ".join(line[1:])
+                self.sendCmd("PONG %s" % (token[1:] if token.startswith(":") else token))
+            elif self.lag_sent and len(line) > 3 and line[1] == "PONG" and line[3].lstrip(":") == "snekbot-lag":
+                self.lag = self.last_received - self.lag_sent
+                self.lag_checked = self.lag_sent
+                self.lag_sent = 0
+                self.debug("Lag: %.3f seconds", self.lag, category="lag")
+            else:
+                self.enqueue(line)
+
+    def enqueue(self, line):
+        """
+        Add an event to the backlog
+
+        Events are queued per tier (see event_tier()), so room can be made in a full backlog without having to look
+        through it. If the backlog is full, the oldest event of the least valuable tier that has any is pushed out:
+
+        - `low`: chatter and server messages the bot ignores; these are dropped
+        - `coalesce`: channel membership changes; instead of being dropped, these are applied to what the bot keeps
+          track of right away, but not logged or passed to plugins (see coalesce())
+        - `normal`: commands and everything else; these are dropped
+        - `keep`: events the bot cannot do without, e.g. the end of registration; these are never dropped, even if
+          the backlog is full
+
+        If the incoming event is itself the least valuable one, it is pushed out instead.
+
+        :param list line:  Event, as a list of words
+        """
+        tier = self.event_tier(line)
+
+        if self.backlog_length >= config.backlog_size:
+            if not self.backlog_full:
+                self.backlog_full = True
+                self.debug("Backlog full (%i events), pushing out events", self.backlog_length,
+                           level=logging.WARNING, category="backlog")
+
+            for push_tier in self.BACKLOG_TIERS:
+                if push_tier == "keep":
+                    break
+                elif self.backlog[push_tier]:
+                    self.push_out(self.backlog[push_tier].popleft()[1], push_tier)
+                    self.backlog_length -= 1
+                    break
+                elif push_tier == tier:
+                    self.push_out(line, tier)
+                    return
+
+        elif self.backlog_full and self.backlog_length < config.backlog_size / 2:
+            self.backlog_full = False
+            self.debug("Backlog cleared up, %i events dropped and %i coalesced so far",
+                       sum(self.backlog_dropped.values()), sum(self.backlog_coalesced.values()),
+                       level=logging.INFO, category="backlog")
+
+        self.backlog_sequence += 1
+        self.backlog[tier].append((self.backlog_sequence, line))
+        self.backlog_length += 1
+        self.backlog_peak = max(self.backlog_peak, self.backlog_length)
+
+    def next_event(self):
+        """
+        Take the oldest event from the backlog
+
+        :return list:  Event, as a list of words
+        """
+        oldest = min((events for events in self.backlog.values() if events), key=lambda events: events[0][0])
+        self.backlog_length -= 1
+
+        return oldest.popleft()[1]
+
+    def push_out(self, line, tier):
+        """
+        Get rid of an event that does not fit in the backlog
+
+        :param list line:  Event
+        :param string tier:  Backlog tier of the event
+        """
+        if tier == "coalesce":
+            self.backlog_coalesced[self.event_type(line)] += 1
+            self.coalesce(line)
+        else:
+            self.backlog_dropped[self.event_type(line)] += 1
+
+    def coalesce(self, line):
+        """
+        Apply the part of an event that cannot be skipped
+
+        Called for events in the `coalesce` tier that are pushed out of a full backlog. Does nothing by default;
+        clients that keep track of state, e.g. who is in which channel, should override this to update it.
+
+        :param list line:  Event, as a list of words
+        """
+        pass
+
+    def event_tier(self, line):
+        """
+        Get the backlog tier of an event
+
+        :param list line:  Event, as a list of words
+        :return string:  One of `BACKLOG_TIERS`
+        """
+        event_type = self.event_type(line)
+
+        if event_type in config.backlog_keep:
+            return "keep"
+        elif event_type in config.backlog_coalesce:
+            # our own joins, parts and nickname changes matter too much to skip any of their processing
+            if line[0][1:].split("!")[0] == self.nickname or (event_type == "KICK" and line[3:4] == [self.nickname]):
+                return "keep"
+            return "coalesce"
+        elif event_type in config.backlog_low_priority:
+            # ...but commands are worth keeping
+            if event_type == "PRIVMSG" and len(line) > 3 and line[3][1:].startswith(config.command_prefix):
+                return "normal"
+            return "low"
+
+        return "normal"
+
+    def event_type(self, line):
+        """
+        Get the command or numeric of an event
+
+        :param list line:  Event, as a list of words
+        :return string:  Event type, e.g. `PRIVMSG` or `353`
+        """
+        if line[0].startswith(":"):
+            return line[1].upper() if len(line) > 1 else ""
+
+        return line[0].upper()
+
+    def backlog_stats(self):
         """
-        print("%s" % str(msg).strip())
+        Get statistics about the event backlog
+
+        :return dict:  Current depth, peak depth, and amount of dropped and coalesced events per event type
+        """
+        return {
+            "depth": self.backlog_length,
+            "peak": self.backlog_peak,
+            "dropped": dict(self.backlog_dropped),
+            "coalesced": dict(self.backlog_coalesced)
+        }
+
+    def dispatch(self, line):
+        """
+        Handle an event from the backlog
+
+        :param list line:  Event, as a list of words
+        """
+        if line[0][0] == ":":
+            sender = line[0][1:]
+            try:
+                self.process(line, sender)
+            except Exception as error_message:
+                # keep the bot running at all costs!!
+                self.debug("Error during processing: %s", error_message, level=logging.ERROR, line=line)
+        elif line[0] == "ERROR":
+            msg = " ".join(line[1:])[1:]
+            self.debug("/!\\ Server returned error message '%s'", msg, level=logging.ERROR, category="server")
+            if "Ping timeout" in msg or "Ping Timeout" in msg or "Closing link" in msg:
+                self.reconnect()
+            else:
+                self.die()
+
+    def debug(self, msg, *args, level=logging.DEBUG, category="general", **fields):
+        """
+        Log debug message
+
+        Formatting with `args` is deferred until it is certain the message will actually be logged, so pass any
+        values as arguments rather than formatting the message yourself.
+
+        :param msg:  Debug message, optionally with %-style placeholders
+        :param args:  Values for placeholders
+        :param int level:  Log level
+        :param string category:  Category of the message
+        :param fields:  Structured data to log with the message
+        """
+        self.debuglog.log(level, str(msg).strip(), *args, category=category, **fields)
 
     def process(self, msg, sender):
         """
@@ -139,20 +478,206 @@ class irc_client:
 
         :param cmd:  Command to send
         """
-        cmd = cmd.strip() + "\r\n"
-        try:
-            self.ircsocket.send(cmd.encode("ascii"))
-        except UnicodeEncodeError:
-            self.debug(">>> Could not send command, invalid ascii characters: %s" % cmd)
+        self.sendCmds([cmd])
+
+    def sendCmds(self, cmds):
+        """
+        Send several raw IRC commands at once
+
+        The commands are sent with a single write to the socket.
+
+        :param list cmds:  Commands to send
+        """
+        data = b""
+        for cmd in cmds:
+            cmd = cmd.strip() + "\r\n"
+            try:
+                data += cmd.encode("utf-8")
+            except UnicodeEncodeError:
+                self.debug(">>> Could not send command, invalid characters: %s", cmd, level=logging.WARNING)
+
+        if data:
+            self.ircsocket.sendall(data)
 
     def sendMsg(self, channel, msg):
         """
         Send message to channel or user
 
+        Thin wrapper around reply() - long messages are split over several lines, but never paged.
+
         :param channel:  Channel to send to - can also be a username
         :param msg:  Message to send
         """
-        self.sendCmd("PRIVMSG %s :%s" % (channel, msg))
+        self.reply(channel, msg)
+
+    def reply(self, target, msg, requester=None):
+        """
+        Send a message to one or more channels or users
+
+        Messages that would not fit in one IRC line are split over several lines, as are messages containing newlines.
+        If a message is sent to several targets, these are combined into as few PRIVMSG commands as the server
+        allows.
+
+        If `requester` is given and the message is longer than `config.reply_max_lines` lines, only the first lines
+        are sent; the rest is kept, along with where it was sent to, until the requester asks for more via more().
+
+        :param target:  Channel or nickname to send to, or a list of them
+        :param msg:  Message to send
+        :param requester:  Identifier (e.g. hostname) of the user this is a reply to, to enable paging
+        """
+        if isinstance(target, str):
+            targets = [target]
+        elif isinstance(target, (list, tuple, set)):
+            targets = list(target)
+        else:
+            targets = []
+
+        if not targets or not all(isinstance(name, str) and name for name in targets):
+            self.debug("Not sending message to invalid target %r", target, level=logging.ERROR, category="server")
+            return
+
+        for batch in self.batch_targets(targets):
+            recipient = ",".join(batch)
+            lines = self.split_message(msg, self.message_limit(recipient))
+
+            if requester and len(lines) > config.reply_max_lines:
+                remaining = lines[config.reply_max_lines:]
+                lines = lines[:config.reply_max_lines]
+                lines.append("(%i more lines - say %smore to see them)" % (len(remaining), config.command_prefix))
+
+                self.pages.pop(requester, None)
+                self.pages[requester] = (recipient, remaining)
+                while len(self.pages) > config.reply_max_pages:
+                    del self.pages[next(iter(self.pages))]
+
+            elif requester:
+                self.pages.pop(requester, None)
+
+            self.sendCmds(["PRIVMSG %s :%s" % (recipient, line) for line in lines])
+
+    def more(self, requester):
+        """
+        Send the next page of a paged reply
+
+        The page goes to wherever the reply was sent, not to where more was asked for, so e.g. a reply sent privately
+        stays private.
+
+        :param requester:  Identifier of the user the reply was for, as passed to reply()
+        :return bool:  `False` if there was nothing left to send
+        """
+        page = self.pages.pop(requester, None)
+        if not page:
+            return False
+
+        target, remaining = page
+        self.reply(target, "\n".join(remaining), requester)
+        return True
+
+    def split_message(self, msg, limit):
+        """
+        Split a message into lines of at most `limit` bytes
+
+        Lines are split at newlines first, then at the last space that fits, and if there is no such space, at the last
+        UTF-8 character boundary that fits. Empty lines are left out, since they cannot be sent.
+
+        :param msg:  Message to split
+        :param int limit:  Maximum length of a line, in bytes
+        :return list:  Lines
+        """
+        lines = []
+        for line in str(msg).replace("\r", "").split("\n"):
+            encoded = line.encode("utf-8", errors="replace")
+
+            while len(encoded) > limit:
+                cut = encoded.rfind(b" ", 0, limit + 1)
+                if cut > 0:
+                    lines.append(encoded[:cut].decode("utf-8"))
+                    encoded = encoded[cut + 1:]
+                    continue
+
+                # no space to split on; don't cut a multi-byte character in half
+                cut = limit
+                while cut > 0 and encoded[cut] & 0xC0 == 0x80:
+                    cut -= 1
+                lines.append(encoded[:cut].decode("utf-8"))
+                encoded = encoded[cut:]
+
+            if encoded.strip():
+                lines.append(encoded.decode("utf-8"))
+
+        return lines
+
+    def message_limit(self, target, command="PRIVMSG"):
+        """
+        Determine how many bytes of message fit in one line
+
+        Lines as relayed by the server, including our own hostmask as prefix, may be at most 512 bytes. If we do not
+        know our hostmask yet, assume the longest hostname possible.
+
+        :param target:  Target of the message, as it will be sent
+        :param command:  Command used to send the message
+        :return int:  Maximum message length, in bytes
+        """
+        hostmask = self.hostmask if self.hostmask else "%s!~%s@%s" % (self.nickname, config.identid, "x" * 63)
+        overhead = len((":%s %s %s :\r\n" % (hostmask, command, target)).encode("utf-8"))
+
+        return 512 - overhead
+
+    def batch_targets(self, targets, command="PRIVMSG"):
+        """
+        Group message targets into batches that may be sent as one command
+
+        The amount of targets per command is limited by what the server advertises through TARGMAX or MAXTARGETS,
+        and by the space the target list takes up in the line.
+
+        :param list targets:  Targets
+        :param command:  Command the targets are for
+        :return list:  List of lists of targets
+        """
+        max_targets = self.max_targets(command)
+        batches = []
+
+        for target in targets:
+            if batches and (not max_targets or len(batches[-1]) < max_targets) \
+                    and self.message_limit(",".join(batches[-1] + [target]), command) >= 256:
+                batches[-1].append(target)
+            else:
+                batches.append([target])
+
+        return batches
+
+    def max_targets(self, command="PRIVMSG"):
+        """
+        Get the maximum amount of targets the server allows for a command
+
+        :param command:  Command, e.g. `PRIVMSG`
+        :return int:  Maximum amount of targets, or `None` if there is no limit
+        """
+        if "TARGMAX" in self.isupport:
+            for limit in self.isupport["TARGMAX"].split(","):
+                limit_command, _, amount = limit.partition(":")
+                if limit_command.upper() == command:
+                    return int(amount) if amount else None
+        elif "MAXTARGETS" in self.isupport and self.isupport["MAXTARGETS"]:
+            return int(self.isupport["MAXTARGETS"])
+
+        return 1
+
+    def parse_isupport(self, tokens):
+        """
+        Store the server features advertised in an RPL_ISUPPORT (005) reply
+
+        :param list tokens:  Parameters of the reply, excluding our own nickname
+        """
+        for token in tokens:
+            if token.startswith(":"):
+                break
+
+            feature, _, value = token.partition("=")
+            if feature.startswith("-"):
+                self.isupport.pop(feature[1:].upper(), None)
+            else:
+                self.isupport[feature.upper()] = value
 
     def sendErrorMsg(self, channel, msg):
         """
@@ -4,14 +4,44 @@ import abc
 class base_plugin:
     """
     Plugin base class. All plugins classes need to extend from this class to function.
+
+    Besides a `command` method, plugins may implement methods for IRC events: `on_privmsg`, `on_notice`, `on_join`,
+    `on_part`, `on_kick`, `on_quit`, `on_nick`, `on_topic` and `on_mode`, each called with `message`, `channel` and
+    `user` arguments. Set `channels` to a list of channels to only receive events from those channels.
+
+    To store data, plugins can use `self.store`, a key-value store of their own: `self.store.get(key)`,
+    `self.store.set(key, value)`, `self.store.increment(key)`, et cetera. See `store.key_value_store`. Changing a
+    stored list or dict in place does not save it; call `set()` again afterwards.
     """
     cmd = None
+    channels = None
+    store = None
 
     def __init__(self, cmd):
         """
         :param commands.command_module cmd:  Command module
         """
         self.cmd = cmd
+        self.store = cmd.store.namespace(self.__class__.__name__)
+
+    def get_state(self):
+        """
+        Get state to keep when the plugin is reloaded or the bot restarts
+
+        Override this to keep state around; it is saved in state snapshots and passed to `set_state()` when the
+        plugin is loaded again. It should consist of things that can be stored as JSON: dicts, lists, strings, numbers.
+
+        :return:  State, or `None` if there is nothing to keep
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restore state saved earlier with `get_state()`
+
+        :param state:  Saved state
+        """
+        pass
 
 
 class admin_plugin(base_plugin):
@@ -19,9 +49,12 @@ class admin_plugin(base_plugin):
     Admin plugin base class.
 
     This allows child classes to implement an `admin_command` method rather than the normal `command` method; it
-    functions the same as the `command` method, but is only called if the user's level is at least equal to
-    `LEVEL_ADMIN`.
+    functions the same as the `command` method, but is only called if the user's global level is at least equal to
+    `LEVEL_ADMIN`. Commands that only act on the channel they are given in can set `channel_scoped` to `True`, in
+    which case access rules for that channel count as well.
     """
+    channel_scoped = False
+
     def command(self, message, channel, user):
         """Checks if the user has a sufficient user level, and calls the `admin_command` class method, if it exists.
 
@@ -30,7 +63,7 @@ class admin_plugin(base_plugin):
         :param user.user user:  User that gave the command
         :return bool: `True` if the command was valid, `False` if it could not be processed
         """
-        if user.level < user.LEVEL_ADMIN:
+        if user.get_level(channel if self.channel_scoped else "") < user.LEVEL_ADMIN:
             return False
 
         if getattr(self, "admin_command") and not inspect.isabstract(self.admin_command):
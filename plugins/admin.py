@@ -1,4 +1,5 @@
 import importlib
+import time
 import sys
 
 from plugin import admin_plugin
@@ -8,3 +9,107 @@ class reload(admin_plugin):
     def admin_command(self, message, channel, user):
         self.cmd.load_plugins()
         importlib.reload(sys.modules["config"])
+
+
+class debuglog(admin_plugin):
+    def admin_command(self, message, channel, user):
+        """
+        Send the most recent debug log entries to the admin that asked for them
+
+        Usage: `!debuglog [amount]`, `amount` defaulting to 10. Long output is paged; say `!more` to see the rest.
+        The log includes private messages, so it is only ever sent privately, including the pages after the first.
+        """
+        arguments = message.split(" ")
+        try:
+            amount = int(arguments[1]) if len(arguments) > 1 else 10
+        except ValueError:
+            return False
+
+        entries = ["%s %s [%s] %s" % (time.strftime("%H:%M:%S", time.localtime(record.created)), record.levelname,
+                                     getattr(record, "category", "general"), record.getMessage())
+                   for record in self.cmd.irc.debuglog.recent(amount)]
+
+        # paged, so asking for a lot of entries does not flood us off the server; more() sends further pages to the
+        # same target, so they stay private even if !more is said in a channel
+        self.cmd.irc.reply(user.nickname, "\n".join(entries) if entries else "No debug log entries yet.",
+                           user.hostname)
+
+        return True
+
+
+class backlog(admin_plugin):
+    def admin_command(self, message, channel, user):
+        """
+        Report on the backlog of incoming events waiting to be processed
+        """
+        stats = self.cmd.irc.backlog_stats()
+        dropped = ", ".join("%s: %i" % (event_type, amount) for event_type, amount in sorted(stats["dropped"].items()))
+        coalesced = ", ".join("%s: %i" % (event_type, amount) for event_type, amount in
+                              sorted(stats["coalesced"].items()))
+
+        self.cmd.irc.reply(channel, "Backlog: %i events waiting (peak %i). Dropped: %s. Coalesced: %s" % (
+            stats["depth"], stats["peak"], dropped if dropped else "none", coalesced if coalesced else "none"))
+
+        return True
+
+
+class acl(admin_plugin):
+    def admin_command(self, message, channel, user):
+        """
+        Manage access rules
+
+        Usage:
+        - `!acl add <mask> <level> [channel]`: give everyone matching `mask` (e.g. `*!*@*.example.net`) the user level
+          `level` (a number, or `admin`, `service` or `user`), optionally only in `channel`. Rules can only raise
+          levels, so levels below `user` are not accepted.
+        - `!acl del <mask> [channel]`: remove a rule
+        - `!acl list`: list all rules
+        - `!acl check <hostmask> [channel]`: show which level the rules give a hostmask
+        """
+        arguments = message.split(" ")[1:]
+        if not arguments:
+            return False
+
+        rules = self.cmd.irc.acl
+        action = arguments[0].lower()
+
+        if action == "add" and len(arguments) in (3, 4):
+            level = arguments[2]
+            if not level.isdigit():
+                level = getattr(user, "LEVEL_" + level.upper(), None)
+                if level is None:
+                    self.cmd.irc.sendErrorMsg(channel, "Unknown user level %s" % arguments[2])
+                    return False
+
+            if int(level) < user.LEVEL_USER:
+                self.cmd.irc.sendErrorMsg(channel, "Access rules can only raise user levels")
+                return False
+
+            rule_channel = arguments[3] if len(arguments) == 4 else ""
+            if not rules.add(arguments[1], int(level), rule_channel):
+                self.cmd.irc.sendErrorMsg(channel, "Invalid mask %s, use nick!ident@host" % arguments[1])
+                return False
+
+            self.cmd.irc.reply(channel, "Rule added: %s has level %i%s" % (
+                rules.normalize(arguments[1]), int(level), " in %s" % rule_channel if rule_channel else ""))
+
+        elif action == "del" and len(arguments) in (2, 3):
+            if rules.remove(arguments[1], arguments[2] if len(arguments) == 3 else ""):
+                self.cmd.irc.reply(channel, "Rule removed.")
+            else:
+                self.cmd.irc.sendErrorMsg(channel, "No such rule.")
+                return False
+
+        elif action == "list":
+            listing = ["%s: %i%s" % (mask, level, " in %s" % rule_channel if rule_channel else "")
+                       for mask, rule_channel, level in rules.rules()]
+            self.cmd.irc.reply(channel, "\n".join(listing) if listing else "No rules.", user.hostname)
+
+        elif action == "check" and len(arguments) in (2, 3):
+            level = rules.level(arguments[1], arguments[2] if len(arguments) == 3 else "")
+            self.cmd.irc.reply(channel, "%s: %s" % (arguments[1], "no matching rule" if level is None else level))
+
+        else:
+            return False
+
+        return True
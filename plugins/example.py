@@ -16,9 +16,12 @@ class example(base_plugin):
         Echoes back what the user said. The `command` method is called when the command is
         given by a user.
 
+        Replies are sent with `reply()`, which splits long messages over several lines. Passing the user's hostname
+        pages replies longer than a few lines: the user can then say `!more` to see the rest.
+
         :param string message: Full command message
         :param string channel: Channel the command was given on
         :param user.user user: User object
         :return:
         """
-        self.cmd.irc.sendMsg(channel, "Your nickname is %s and you said: %s" % (user.nickname, message))
+        self.cmd.irc.reply(channel, "Your nickname is %s and you said: %s" % (user.nickname, message), user.hostname)
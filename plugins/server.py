@@ -0,0 +1,23 @@
+from plugin import base_plugin
+
+
+class lag(base_plugin):
+    """
+    Report the lag between the bot and the IRC server
+    """
+
+    def command(self, message, channel, user):
+        """Respond to the '!lag' command
+
+        :param string message: Full command message
+        :param string channel: Channel the command was given on
+        :param user.user user: User object
+        :return:
+        """
+        lag = self.cmd.irc.current_lag()
+        if lag is None:
+            self.cmd.irc.reply(channel, "Lag has not been measured yet.")
+        else:
+            self.cmd.irc.reply(channel, "Lag: %.3f seconds" % lag)
+
+        return True
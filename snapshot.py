@@ -0,0 +1,88 @@
+import gzip
+import json
+import logging
+import os
+import time
+
+from data.config import config
+
+
+class snapshot:
+    """
+    State snapshots
+
+    Saves the bot's warm state - who is in which channel, channel modes, known hostmasks, and any state plugins want
+    to keep - to a compressed file, so it can pick up where it left off after a restart instead of having to WHOIS
+    everyone in every channel again.
+    """
+    VERSION = 1
+
+    def __init__(self, irc):
+        """
+        :param snekbot irc:  The bot
+        """
+        self.irc = irc
+        self.last_saved = time.time()
+
+    def save(self):
+        """
+        Save a snapshot
+
+        The file is written under a temporary name first, and then moved into place, so a crash halfway through does
+        not leave a corrupt snapshot behind.
+        """
+        state = {
+            "version": self.VERSION,
+            "time": time.time(),
+            "host": config.host,
+            "channels": self.irc.channels + [channel for channel in self.irc.rejoin_channels
+                                             if channel not in self.irc.channels],
+            "tracker": self.irc.channel_tracker.get_state(),
+            "plugins": self.irc.command_module.get_plugin_states()
+        }
+
+        temporary_file = config.snapshot_file + ".tmp"
+        try:
+            with gzip.open(temporary_file, "wt", encoding="utf-8") as output:
+                json.dump(state, output, separators=(",", ":"))
+            os.replace(temporary_file, config.snapshot_file)
+        except (OSError, TypeError, ValueError) as error_message:
+            self.irc.debug("Could not save snapshot: %s", error_message, level=logging.WARNING, category="snapshot")
+            return
+
+        self.last_saved = time.time()
+        self.irc.debug("Saved snapshot to %s", config.snapshot_file, category="snapshot")
+
+    def load(self):
+        """
+        Load the last snapshot, if there is a recent enough one for the current server
+
+        Channels from the snapshot are rejoined once we are logged on. The restored member lists are replaced as soon
+        as the server sends fresh ones, but the hostmasks we already know are kept, so only people that are new to
+        us need to be looked up.
+
+        :return bool:  Whether a snapshot was loaded
+        """
+        try:
+            with gzip.open(config.snapshot_file, "rt", encoding="utf-8") as snapshot_file:
+                state = json.load(snapshot_file)
+        except (OSError, EOFError, ValueError) as error_message:
+            self.irc.debug("No usable snapshot: %s", error_message, category="snapshot")
+            return False
+
+        if state.get("version") != self.VERSION or state.get("host") != config.host:
+            return False
+
+        age = time.time() - state.get("time", 0)
+        if age > config.snapshot_max_age:
+            self.irc.debug("Ignoring snapshot, it is %i seconds old", age, category="snapshot")
+            return False
+
+        self.irc.rejoin_channels += [channel for channel in state.get("channels", [])
+                                     if channel not in self.irc.rejoin_channels]
+        self.irc.channel_tracker.set_state(state.get("tracker", {}))
+        self.irc.command_module.set_plugin_states(state.get("plugins", {}))
+
+        self.irc.debug("Loaded snapshot from %i seconds ago (%i known hostmasks)", age,
+                       len(self.irc.channel_tracker.hostmasks), category="snapshot")
+        return True
@@ -1,6 +1,11 @@
+import logging
 import sqlite3
+import time
 
 from logger import logger
+from acl import acl
+from channel import channel_tracker
+from snapshot import snapshot
 from commands import command_module
 from user import user
 from irc import irc_client
@@ -24,6 +29,7 @@ class snekbot(irc_client):
         self.db.text_factory = str
         self.db.row_factory = sqlite3.Row
         self.load_modules()
+        self.snapshot.load()
 
     def load_modules(self, channel=False):
         """
@@ -31,8 +37,11 @@ class snekbot(irc_client):
 
         :param channel:  Channel to send error message to if things go wrong - can also be a nickname
         """
+        self.acl = acl(self)
         self.command_module = command_module(self)
         self.logger = logger(self)
+        self.channel_tracker = channel_tracker(self)
+        self.snapshot = snapshot(self)
 
     def process(self, msg, sender):
         """
@@ -51,16 +60,18 @@ class snekbot(irc_client):
             return False
 
         message = " ".join(msg[3:])[1:]
+        self.channel_tracker.seen(recv_user.nickname, sender)
 
         if msg[1] == "PRIVMSG":
             channel = msg[2]
             self.on_privmsg(message, channel, recv_user)
         elif msg[1] == "NOTICE":
-            self.on_notice(message, recv_user)
+            channel = msg[2]
+            self.on_notice(message, channel, recv_user)
         elif msg[1] == "NICK":
-            self.on_nick(msg[2][1:], recv_user)
+            self.on_nick(msg[2].lstrip(":"), recv_user)
         elif msg[1] == "JOIN":
-            channel = msg[2]
+            channel = msg[2].lstrip(":")
             self.on_join(channel, recv_user)
         elif msg[1] == "PART":
             channel = msg[2]
@@ -74,9 +85,10 @@ class snekbot(irc_client):
             channel = msg[2]
             self.on_topic(message, channel, recv_user)
         elif msg[1] == "MODE":
-            self.on_mode(message, recv_user)
-        elif self.debugmode == "verbose":
-            self.debug("Unrecognized command %s from %s" % (msg[1], recv_user.nickname))
+            channel = msg[2]
+            self.on_mode(" ".join(msg[3:]), channel, recv_user)
+        else:
+            self.debug("Unrecognized command %s from %s", msg[1], recv_user.nickname, category="server")
 
     def on_privmsg(self, msg, channel, sender):
         """
@@ -92,10 +104,11 @@ class snekbot(irc_client):
         self.logger.log(msg, channel, sender)
 
         if channel == self.nickname:
-            channel = sender.info("lastnick")
+            channel = sender.nickname
 
         self.command_module.process(msg, channel, sender)
-        self.debug("[" + channel.rjust(14) + "] " + sender.nickname.rjust(14) + ": " + msg)
+        self.command_module.dispatch_event("PRIVMSG", msg, channel, sender)
+        self.debug("[%14s] %14s: %s", channel, sender.nickname, msg, category="privmsg")
 
     def on_servermsg(self, msg):
         """
@@ -106,22 +119,47 @@ class snekbot(irc_client):
         """
         msgcode = msg[1]
 
-        if msgcode == "376":  # log on
+        if msgcode == "005":  # supported features
+            self.parse_isupport(msg[3:])
+
+        elif msgcode == "396":  # displayed host changed
+            if self.hostmask:
+                self.hostmask = self.hostmask.split("@")[0] + "@" + msg[3]
+
+        elif msgcode in ("376", "422"):  # log on: end of MOTD, or no MOTD at all
             self.nick(config.nickname)
-            for channel in config.preferredchannels:
-                self.join(channel)
+            self.registered()
 
         elif msgcode == "311":  # whois reply
             hostmask = "%s!%s@%s" % (msg[3], msg[4], msg[5])
+            self.channel_tracker.whois(msg[3], hostmask)
 
             # this registers the user in the database
             user(self, hostmask)
 
+        elif msgcode == "318":  # end of whois reply
+            self.channel_tracker.whois_end(msg[3])
+
         elif msgcode == "353":  # NAMES reply
-            nicknames = msg[5:]
-            for nickname in nicknames:
-                nickname = nickname.replace("@", "").replace("+", "")
-                self.sendCmd("WHOIS %s" % nickname)
+            nicknames = [nickname.lstrip(":") for nickname in msg[5:]]
+            self.channel_tracker.names(msg[4], nicknames)
+
+        elif msgcode == "366":  # end of NAMES reply
+            # only look up people we did not know yet, e.g. from a snapshot
+            unknown = self.channel_tracker.names_end(msg[3])
+            self.sendCmds(["WHOIS %s" % nickname for nickname in unknown])
+
+            members = self.channel_tracker.members[msg[3].lower()]
+            self.debug("Looking up %i of %i members of %s", len(unknown), len(members), msg[3], category="snapshot")
+
+        elif msgcode in ("403", "405", "471", "473", "474", "475"):  # could not join channel
+            self.channel_tracker.forget(msg[3])
+            self.channels = [channel for channel in self.channels if channel.lower() != msg[3].lower()]
+            self.debug("Could not join %s: %s", msg[3], " ".join(msg[4:]).lstrip(":"), level=logging.WARNING,
+                       category="server")
+
+        elif msgcode == "324":  # channel modes
+            self.channel_tracker.channel_modes(msg[3], msg[4], msg[5:])
 
         elif msgcode == "433":  # nickname already in use
             if self.nickname_retries == 0:
@@ -134,13 +172,14 @@ class snekbot(irc_client):
                 self.nickname = lame_nickname
                 self.nickname_retries += 1
 
-    def on_notice(self, msg, sender):
+    def on_notice(self, msg, channel, sender):
         """
         Handle notices
 
-        Just debug them... nothing to process for now
+        Identify with NickServ if needed, and otherwise just pass them on to plugins
 
         :param msg:  Message
+        :param channel:  Channel or nickname the notice was sent to
         :param sender:  Who sent the message (user object)
         :return:
         """
@@ -152,7 +191,9 @@ class snekbot(irc_client):
                 # we're logged in
                 pass
 
-        self.debug("[" + str("NOTICE").rjust(14) + "] " + sender.nickname.rjust(14) + ": " + msg)
+        self.command_module.dispatch_event("NOTICE", msg, channel, sender)
+
+        self.debug("[%14s] %14s: %s", "NOTICE", sender.nickname, msg, category="notice")
 
     def on_topic(self, msg, channel, sender):
         """
@@ -163,6 +204,7 @@ class snekbot(irc_client):
         :param sender:  Who set the topic
         """
         self.logger.log(msg, channel, sender, "TOPIC")
+        self.command_module.dispatch_event("TOPIC", msg, channel, sender)
 
     def on_nick(self, msg, sender):
         """
@@ -171,6 +213,11 @@ class snekbot(irc_client):
         :param msg:  New nickname
         :param sender:  Who changed their nickname (user object)
         """
+        channels = self.channel_tracker.rename(sender.nickname, msg)
+        if sender.nickname == self.nickname:
+            self.nickname = msg
+
+        self.command_module.dispatch_event("NICK", msg, "", sender, channels)
         sender.rename(msg)
 
         self.logger.log(msg, "", sender, "NICK")
@@ -184,10 +231,17 @@ class snekbot(irc_client):
         :param channel:  Channel that was joined
         :param sender:  Who joined (user object)
         """
-        if sender.level >= user.LEVEL_ADMIN:
+        self.channel_tracker.join(channel, sender.nickname, sender.ident)
+
+        if sender.nickname == self.nickname:
+            # the server tells us our own hostmask; useful to know how long our messages may be
+            self.hostmask = sender.ident
+            self.sendCmd("MODE %s" % channel)
+        elif sender.get_level(channel) >= user.LEVEL_ADMIN:
             sender.add_mode(channel, "o")
 
         self.logger.log("", channel, sender, "JOIN")
+        self.command_module.dispatch_event("JOIN", "", channel, sender)
 
     def on_quit(self, msg, sender):
         """
@@ -197,7 +251,9 @@ class snekbot(irc_client):
         :param sender:  Who quit (user object)
         :return:
         """
+        channels = self.channel_tracker.quit(sender.nickname)
         self.logger.log(msg, "", sender, "QUIT")
+        self.command_module.dispatch_event("QUIT", msg, "", sender, channels)
 
     def on_part(self, msg, channel, sender):
         """
@@ -208,7 +264,9 @@ class snekbot(irc_client):
         :param sender:  Who parted (user object)
         :return:
         """
+        self.channel_tracker.part(channel, sender.nickname)
         self.logger.log(msg, channel, sender, "PART")
+        self.command_module.dispatch_event("PART", msg, channel, sender)
 
     def on_kick(self, msg, channel, sender):
         """
@@ -218,23 +276,89 @@ class snekbot(irc_client):
         :param channel:  Channel that person was kicked from
         :param sender:  Who parted (user object)
         """
+        self.channel_tracker.part(channel, msg.split(" ")[0])
         self.logger.log(msg, channel, sender, "KICK")
+        self.command_module.dispatch_event("KICK", msg, channel, sender)
 
-    def on_mode(selfself, msg, sender):
+    def on_mode(self, msg, channel, sender):
         """
-        Log mode changes
+        Keep track of mode changes
 
-        :param msg:  Mode update
-        :param sender:  Who parted (user object)
+        :param msg:  Mode update, i.e. the modes followed by their parameters
+        :param channel:  Channel (or nickname) the modes were set on
+        :param sender:  Who set the modes (user object)
         """
-        pass
+        modes = [word.lstrip(":") for word in msg.split(" ")]
+        self.channel_tracker.mode(channel, modes[0], modes[1:])
+        self.command_module.dispatch_event("MODE", msg, channel, sender)
+
+    def coalesce(self, line):
+        """
+        Apply an event that was pushed out of a full backlog to the channel tracker
+
+        This skips everything else the event would normally lead to: it is not logged, plugins do not hear about it
+        and nobody is auto-opped, but we still know who is in which channel.
+
+        :param list line:  Event, as a list of words
+        """
+        event_type = self.event_type(line)
+        if event_type.isdigit():
+            # the numerics in this tier (NAMES, WHOIS, channel modes) only update the tracker anyway
+            self.on_servermsg(line)
+            return
+
+        hostmask = line[0][1:]
+        nickname = hostmask.split("!")[0]
+        target = line[2].lstrip(":") if len(line) > 2 else ""
+
+        if event_type == "JOIN":
+            self.channel_tracker.join(target, nickname, hostmask)
+        elif event_type == "PART":
+            self.channel_tracker.part(target, nickname)
+        elif event_type == "KICK" and len(line) > 3:
+            self.channel_tracker.part(target, line[3])
+        elif event_type == "QUIT":
+            self.channel_tracker.quit(nickname)
+        elif event_type == "NICK":
+            self.channel_tracker.rename(nickname, target)
+        elif event_type == "MODE" and len(line) > 3:
+            modes = [word.lstrip(":") for word in line[3:]]
+            self.channel_tracker.mode(target, modes[0], modes[1:])
+
+    def reconnect(self):
+        """
+        Drop the current connection and set up a new one
+
+        What we know about our channels is kept, but marked as stale until we have rejoined them.
+        """
+        self.channel_tracker.mark_stale()
+        super().reconnect()
+
+    def tick(self):
+        """
+        Periodic tasks
+
+        Saves a state snapshot every `config.snapshot_interval` seconds and writes pending changes to the plugin
+        key-value store every `config.store_flush_interval` seconds, on top of the IRC client's periodic tasks.
+        """
+        super().tick()
+
+        if time.time() - self.command_module.store.last_flushed >= config.store_flush_interval:
+            self.command_module.store.flush()
+
+        if time.time() - self.snapshot.last_saved >= config.snapshot_interval:
+            self.snapshot.save()
 
     def die(self, quitmsg="brb!"):
         """
         Quit IRC
 
+        A snapshot of the bot's state is saved first, so it can start up quickly next time.
+
         :param quitmsg:  Quit message
         """
+        self.snapshot.save()
+        self.command_module.store.flush()
         self.db.close()
         self.alive = False
         self.sendCmd("QUIT :%s" % quitmsg)
@@ -0,0 +1,297 @@
+import collections
+import threading
+import sqlite3
+import json
+import logging
+import time
+
+from data.config import config
+
+
+class key_value_store:
+    """
+    Key-value store for plugins
+
+    Values are kept in a bounded in-memory cache. Changes are written back to the database in batches, in a single
+    transaction: when enough of them have piled up, periodically, and when the bot quits. Plugins normally use this
+    through their own namespace (see `base_plugin.store`) rather than directly.
+
+    Values may be strings, numbers, booleans, or anything else that can be stored as JSON; they come back out with
+    the same type.
+    """
+    MISSING = object()
+
+    def __init__(self, irc):
+        """
+        :param irc:  IRC interface
+        """
+        self.irc = irc
+        self.dbconn = irc.db
+        self.database_setup()
+
+        self.cache = collections.OrderedDict()
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.last_flushed = time.time()
+
+    def database_setup(self):
+        """
+        Make sure we have a database connection to work with, and create store table if it does not exist yet
+        """
+        self.db = self.dbconn.cursor()
+
+        try:
+            self.db.execute("SELECT * FROM plugin_store LIMIT 1")
+        except sqlite3.OperationalError:
+            self.db.execute("CREATE TABLE plugin_store (namespace TEXT, key TEXT, type TEXT, value TEXT, "
+                            "PRIMARY KEY (namespace, key))")
+            self.dbconn.commit()
+
+    def namespace(self, namespace):
+        """
+        Get a view of the store limited to one namespace
+
+        :param string namespace:  Namespace, e.g. the name of a plugin
+        :return namespaced_store:
+        """
+        return namespaced_store(self, namespace)
+
+    def encode(self, value):
+        """
+        Turn a value into something that can be stored in the database
+
+        :param value:  Value
+        :return tuple:  Type and value, as strings
+        """
+        if isinstance(value, bool):
+            return "bool", "1" if value else "0"
+        elif isinstance(value, int):
+            return "int", str(value)
+        elif isinstance(value, float):
+            return "float", repr(value)
+        elif isinstance(value, str):
+            return "str", value
+        else:
+            return "json", json.dumps(value)
+
+    def decode(self, value_type, value):
+        """
+        Turn a stored value back into what it was
+
+        :param string value_type:  Type, as returned by encode()
+        :param string value:  Stored value
+        :return:  Value
+        """
+        if value_type == "bool":
+            return value == "1"
+        elif value_type == "int":
+            return int(value)
+        elif value_type == "float":
+            return float(value)
+        elif value_type == "str":
+            return value
+        else:
+            return json.loads(value)
+
+    def load(self, namespace, key):
+        """
+        Get a value, from the cache if possible
+
+        Keys that do not exist are cached too, so asking for them again does not require another query.
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        :return:  Value, or `MISSING`
+        """
+        cache_key = (namespace, key)
+        if cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+            return self.cache[cache_key]
+
+        row = self.db.execute("SELECT type, value FROM plugin_store WHERE namespace = ? AND key = ?",
+                              (namespace, key)).fetchone()
+        value = self.decode(row[0], row[1]) if row else self.MISSING
+        self.cache_value(cache_key, value)
+
+        return value
+
+    def cache_value(self, cache_key, value, dirty=False):
+        """
+        Put a value in the cache
+
+        If the cache is full, the least recently used values are dropped. If any of those have not been written to the
+        database yet, all pending changes are written first; if that fails, nothing is dropped until it succeeds.
+
+        :param tuple cache_key:  Namespace and key
+        :param value:  Value, or `MISSING`
+        :param bool dirty:  Whether the value still needs to be written to the database
+        """
+        self.cache[cache_key] = value
+        self.cache.move_to_end(cache_key)
+        if dirty:
+            self.dirty.add(cache_key)
+
+        while len(self.cache) > config.store_cache_size:
+            oldest = next(iter(self.cache))
+            if oldest in self.dirty:
+                self.flush()
+                if oldest in self.dirty:
+                    break
+            del self.cache[oldest]
+
+        if len(self.dirty) >= config.store_flush_size:
+            self.flush()
+
+    def get(self, namespace, key, default=None):
+        """
+        Get a value
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        :param default:  What to return if there is no value for the key
+        :return:  Value
+        """
+        with self.lock:
+            value = self.load(namespace, key)
+            return default if value is self.MISSING else value
+
+    def set(self, namespace, key, value):
+        """
+        Set a value
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        :param value:  Value
+        """
+        with self.lock:
+            self.encode(value)  # fail now rather than when flushing if the value cannot be stored
+            self.cache_value((namespace, key), value, dirty=True)
+
+    def delete(self, namespace, key):
+        """
+        Delete a value
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        """
+        with self.lock:
+            self.cache_value((namespace, key), self.MISSING, dirty=True)
+
+    def increment(self, namespace, key, amount=1):
+        """
+        Add to a numeric value, atomically
+
+        Keys without a value count as 0.
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        :param amount:  Amount to add
+        :return:  New value
+        """
+        with self.lock:
+            value = self.load(namespace, key)
+            value = amount if value is self.MISSING else value + amount
+            self.cache_value((namespace, key), value, dirty=True)
+
+            return value
+
+    def compare_and_set(self, namespace, key, expected, value):
+        """
+        Set a value, but only if its current value is what we expect it to be, atomically
+
+        :param string namespace:  Namespace
+        :param string key:  Key
+        :param expected:  Expected current value; `None` means the key should not have a value yet
+        :param value:  New value
+        :return bool:  Whether the value was set
+        """
+        with self.lock:
+            current = self.load(namespace, key)
+            if (None if current is self.MISSING else current) != expected:
+                return False
+
+            self.set(namespace, key, value)
+            return True
+
+    def scan(self, namespace, prefix=""):
+        """
+        Get all values with keys that start with a given prefix
+
+        Pending changes are written to the database first, so the result is complete.
+
+        :param string namespace:  Namespace
+        :param string prefix:  Key prefix
+        :return dict:  Key -> value, ordered by key
+        """
+        with self.lock:
+            self.flush()
+            rows = self.db.execute("SELECT key, type, value FROM plugin_store WHERE namespace = ? AND key >= ? "
+                                   "AND key < ? ORDER BY key", (namespace, prefix, prefix + "\U0010ffff")).fetchall()
+
+            return {row[0]: self.decode(row[1], row[2]) for row in rows}
+
+    def flush(self):
+        """
+        Write all pending changes to the database, in one transaction
+
+        If that fails, the transaction is rolled back and the changes are kept, to be written on the next flush.
+        """
+        with self.lock:
+            self.last_flushed = time.time()
+            if not self.dirty:
+                return
+
+            updates = []
+            deletions = []
+            for namespace, key in self.dirty:
+                value = self.cache[(namespace, key)]
+                if value is self.MISSING:
+                    deletions.append((namespace, key))
+                else:
+                    updates.append((namespace, key) + self.encode(value))
+
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO plugin_store (namespace, key, type, value) "
+                                    "VALUES (?, ?, ?, ?)", updates)
+                self.db.executemany("DELETE FROM plugin_store WHERE namespace = ? AND key = ?", deletions)
+                self.dbconn.commit()
+            except sqlite3.Error as error_message:
+                self.dbconn.rollback()
+                self.irc.debug("Could not write key-value store: %s", error_message, level=logging.ERROR,
+                               category="plugin")
+                return
+
+            self.dirty = set()
+
+
+class namespaced_store:
+    """
+    View of the key-value store limited to one namespace
+
+    See `key_value_store` for what the methods do.
+    """
+    def __init__(self, store, namespace):
+        """
+        :param key_value_store store:  Store
+        :param string namespace:  Namespace
+        """
+        self.store = store
+        self.namespace = namespace
+
+    def get(self, key, default=None):
+        return self.store.get(self.namespace, key, default)
+
+    def set(self, key, value):
+        self.store.set(self.namespace, key, value)
+
+    def delete(self, key):
+        self.store.delete(self.namespace, key)
+
+    def increment(self, key, amount=1):
+        return self.store.increment(self.namespace, key, amount)
+
+    def compare_and_set(self, key, expected, value):
+        return self.store.compare_and_set(self.namespace, key, expected, value)
+
+    def scan(self, prefix=""):
+        return self.store.scan(self.namespace, prefix)
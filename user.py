@@ -86,7 +86,7 @@ class user:
                 self.dbconn.commit()
 
             self.data = dict(dbuser)
-            self.level = int(self.info("level"))
+            self.level = self.get_level(level=int(self.info("level")))
             self.init = True
 
     def is_valid(self):
@@ -144,6 +144,23 @@ class user:
         self.db.execute("UPDATE user SET " + field + " = ? WHERE hostname = ?", (value, self.hostname))
         return self.dbconn.commit()
 
+    def get_level(self, channel="", level=None):
+        """
+        Get user level
+
+        This is the level from the database, or the level the access control list assigns to the user's hostmask
+        (globally or in the given channel), whichever is highest.
+
+        :param channel:  Channel to take channel-specific access rules into account for
+        :param level:  Level to use instead of the user's current level
+        :return int:  User level
+        """
+        if level is None:
+            level = self.level
+
+        acl_level = self.irc.acl.level(self.ident, channel)
+        return level if acl_level is None else max(level, acl_level)
+
     def add_mode(self, channel, mode):
         """
         Try to set a new user mode
@@ -168,4 +185,4 @@ class user:
 
         :param msg:  Message to log
         """
-        print("[" + str("USER").rjust(14) + "] %s" % msg)
+        self.irc.debug("[%14s] %s", "USER", msg, category="user")